@@ -5,9 +5,12 @@ Optimized for macOS M2 Air with 8GB RAM
 
 import base64
 import csv
+import hmac
 import io
 import logging
+import math
 import os
+import pstats
 import sys
 import threading
 import time
@@ -15,7 +18,16 @@ from datetime import datetime
 
 import cv2
 import numpy as np
-from flask import Flask, jsonify, render_template, request, send_from_directory
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
 from PIL import Image
 
 # Prometheus metrics
@@ -31,6 +43,9 @@ from prometheus_client import (
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
 from direct_recognizer import create_direct_recognizer
 
+import profiling
+from attendance_summary import AttendanceRollup, iter_export
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -65,17 +80,57 @@ app = Flask(
 )
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB max file size
 
+# Upper bound on candidates returned by /recognize
+MAX_TOP_K = 20
+
+# Upper bound on descriptor jitters accepted by /reembed
+MAX_NUM_JITTERS = int(os.getenv("MAX_NUM_JITTERS", 100))
+
+# Profiling configuration (admin endpoint is disabled unless a token is set)
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")
+# Guards gallery maintenance endpoints such as /reembed
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or PROFILING_TOKEN
+PROFILING_MAX_SECONDS = float(os.getenv("PROFILING_MAX_SECONDS", 30))
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0))  # 0 disables the log
+PROFILING_MIN_INTERVAL = 0.001
+PROFILING_MAX_INTERVAL = 1.0
+PROFILING_SORT_KEYS = sorted(key.value for key in pstats.SortKey)
+
+# Bounds for the next capture interval suggested to clients by /recognize
+CAPTURE_HINT_MIN_MS = int(os.getenv("CAPTURE_HINT_MIN_MS", 1000))
+CAPTURE_HINT_MAX_MS = int(os.getenv("CAPTURE_HINT_MAX_MS", 30000))
+
+
+def record_stage(stage, started):
+    """Record the elapsed time of a request stage for the slow-request log"""
+    if SLOW_REQUEST_MS > 0:
+        g.stages[stage] = round((time.perf_counter() - started) * 1000, 2)
+
 
 # Prometheus middleware
 @app.before_request
 def before_request():
     request.start_time = time.time()
+    g.stages = {}
+    g.profile = profiling.start_request_profile()
     ACTIVE_CONNECTIONS.inc()
 
 
 @app.after_request
 def after_request(response):
+    if g.get("profile"):
+        profiling.finish_request_profile(g.profile)
+        g.profile = None
+
     request_duration = time.time() - request.start_time
+    if SLOW_REQUEST_MS > 0 and request_duration * 1000 > SLOW_REQUEST_MS:
+        logger.warning(
+            f"Slow request: {request.method} {request.path} "
+            f"took {request_duration * 1000:.1f}ms "
+            f"(status: {response.status_code}, stages: {g.get('stages')}, "
+            f"image: {g.get('image_size')})"
+        )
+
     REQUEST_DURATION.labels(
         method=request.method, endpoint=request.endpoint or "unknown"
     ).observe(request_duration)
@@ -126,6 +181,11 @@ def handle_bad_request(e):
 recognizer = None
 attendance_file = "attendance.csv"
 attendance_lock = threading.Lock()
+attendance_rollup = AttendanceRollup()
+
+# Recognitions currently in progress, used as the server load signal
+inflight_recognitions = 0
+inflight_lock = threading.Lock()
 
 
 def init_recognizer():
@@ -137,7 +197,14 @@ def init_recognizer():
         models_dir = os.path.join(backend_dir, "resorces")
         known_faces_dir = os.path.join(backend_dir, "known_faces")
 
-        recognizer = create_direct_recognizer(models_dir, known_faces_dir)
+        # Descriptor jitters for enrolled faces only; live queries never jitter
+        gallery_jitters = min(
+            max(int(os.getenv("FACE_NUM_JITTERS", 0)), 0), MAX_NUM_JITTERS
+        )
+
+        recognizer = create_direct_recognizer(
+            models_dir, known_faces_dir, gallery_jitters
+        )
         logger.info("Face recognizer initialized successfully")
 
     except Exception as e:
@@ -159,15 +226,38 @@ def log_attendance(name, confidence):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
     with attendance_lock:
+        # Pick up rotation or external edits before indexing the new row
+        attendance_rollup.refresh(attendance_file)
         with open(attendance_file, "a", newline="") as f:
             writer = csv.writer(f)
+            # Restore the header if the file was truncated by log rotation
+            if f.tell() == 0:
+                writer.writerow(["Name", "Timestamp", "Confidence"])
+            offset = f.tell()
             writer.writerow([name, timestamp, f"{confidence:.4f}"])
+            end = f.tell()
+        attendance_rollup.record_append(attendance_file, name, timestamp, offset, end)
 
     logger.info(
         f"Logged attendance: {name} at {timestamp} (confidence: {confidence:.4f})"
     )
 
 
+def capture_interval_hint(result, recognize_seconds, inflight):
+    """Suggest how long the client should wait before its next capture (ms)."""
+    hint = CAPTURE_HINT_MIN_MS
+
+    # Nothing in front of the camera, so poll less often
+    if not result.get("face_detected"):
+        hint *= 4
+
+    # Back off under load: scale with concurrent recognitions and latency
+    hint *= max(1, inflight)
+    hint = max(hint, int(recognize_seconds * 4000))
+
+    return min(hint, CAPTURE_HINT_MAX_MS)
+
+
 def decode_image(image_data):
     """Decode image from various formats (base64, file upload, etc.)"""
     try:
@@ -264,6 +354,7 @@ def metrics():
 @app.route("/recognize", methods=["POST"])
 def recognize_face():
     """Face recognition endpoint with automatic attendance logging."""
+    global inflight_recognitions
     try:
         if recognizer is None:
             return jsonify({"error": "Recognizer not initialized"}), 500
@@ -275,14 +366,18 @@ def recognize_face():
             file = request.files["image"]
             if file.filename == "":
                 return jsonify({"error": "No file selected"}), 400
+            started = time.perf_counter()
             image = decode_image(file)
+            record_stage("decode", started)
 
         # Handle JSON with base64 image
         elif request.is_json:
             data = request.get_json()
             if "image" not in data:
                 return jsonify({"error": "No image data provided"}), 400
+            started = time.perf_counter()
             image = decode_image(data["image"])
+            record_stage("decode", started)
 
         else:
             return jsonify({"error": "Invalid request format"}), 400
@@ -292,21 +387,51 @@ def recognize_face():
 
         # Resize image for performance (macOS M2 optimization)
         height, width = image.shape[:2]
+        g.image_size = f"{width}x{height}"
         if width > 640:
+            started = time.perf_counter()
             scale = 640 / width
             new_width = 640
             new_height = int(height * scale)
             image = cv2.resize(image, (new_width, new_height))
+            record_stage("resize", started)
 
-        # Get recognition threshold
+        # Get recognition threshold and open-set decision parameters
         threshold = float(request.args.get("threshold", 0.6))
+        try:
+            top_k = int(request.args.get("top_k", 1))
+            min_margin = float(request.args.get("min_margin", 0.0))
+        except ValueError:
+            return jsonify(
+                {"error": "top_k must be an integer and min_margin a number"}
+            ), 400
+        if not 1 <= top_k <= MAX_TOP_K:
+            return jsonify({"error": f"top_k must be between 1 and {MAX_TOP_K}"}), 400
+        if not (math.isfinite(min_margin) and min_margin >= 0):
+            return jsonify({"error": "min_margin must be a non-negative number"}), 400
 
         # Recognize face using direct dlib approach
-        result = recognizer.recognize_face(image, tolerance=threshold)
+        with inflight_lock:
+            inflight_recognitions += 1
+            inflight = inflight_recognitions
+        started = time.perf_counter()
+        try:
+            result = recognizer.recognize_face(
+                image, tolerance=threshold, top_k=top_k, min_margin=min_margin
+            )
+        finally:
+            with inflight_lock:
+                inflight_recognitions -= 1
+        recognize_seconds = time.perf_counter() - started
+        record_stage("recognize", started)
 
         # Add timestamp and threshold info
         result["timestamp"] = datetime.now().isoformat()
         result["threshold"] = threshold
+        result["min_margin"] = min_margin
+        result["next_capture_ms"] = capture_interval_hint(
+            result, recognize_seconds, inflight
+        )
 
         # Update Prometheus metrics
         if result.get("face_detected"):
@@ -321,7 +446,9 @@ def recognize_face():
 
         # Log attendance if person is recognized
         if result.get("face_detected") and result.get("name"):
+            started = time.perf_counter()
             log_attendance(result["name"], result["confidence"])
+            record_stage("attendance", started)
             result["attendance_logged"] = True
         else:
             result["attendance_logged"] = False
@@ -388,6 +515,78 @@ def get_attendance():
         return jsonify({"error": f"Failed to get attendance: {str(e)}"}), 500
 
 
+def refresh_attendance_rollup():
+    """Re-index the rollup if attendance.csv was rotated or edited externally."""
+    with attendance_lock:
+        attendance_rollup.refresh(attendance_file)
+
+
+def parse_date_range():
+    """Read optional start/end (YYYY-MM-DD) query params; raises ValueError if invalid"""
+    start = request.args.get("start") or None
+    end = request.args.get("end") or None
+    for value in (start, end):
+        if value is not None:
+            datetime.strptime(value, "%Y-%m-%d")
+    return start, end
+
+
+@app.route("/attendance/summary/daily", methods=["GET"])
+def get_daily_summary():
+    """Get daily headcount and record counts for a date range."""
+    try:
+        start, end = parse_date_range()
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD"}), 400
+
+    refresh_attendance_rollup()
+    days = attendance_rollup.daily_summary(start, end)
+    return jsonify({"days": days, "total_days": len(days)})
+
+
+@app.route("/attendance/summary/people", methods=["GET"])
+def get_people_summary():
+    """Get first/last seen and hours present per person for a date range."""
+    try:
+        start, end = parse_date_range()
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD"}), 400
+
+    refresh_attendance_rollup()
+    people = attendance_rollup.person_summary(start, end, request.args.get("name"))
+    return jsonify({"people": people, "total_people": len(people)})
+
+
+@app.route("/attendance/export", methods=["GET"])
+def export_attendance():
+    """Stream attendance records for a date range as CSV or NDJSON."""
+    try:
+        start, end = parse_date_range()
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD"}), 400
+
+    export_format = request.args.get("format", "csv")
+    if export_format == "csv":
+        mimetype = "text/csv"
+    elif export_format == "ndjson":
+        mimetype = "application/x-ndjson"
+    else:
+        return jsonify({"error": "format must be 'csv' or 'ndjson'"}), 400
+
+    refresh_attendance_rollup()
+    offset = attendance_rollup.start_offset(start)
+    if not os.path.exists(attendance_file):
+        offset = None
+
+    return Response(
+        stream_with_context(iter_export(attendance_file, offset, end, export_format)),
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"attachment; filename=attendance.{export_format}"
+        },
+    )
+
+
 @app.route("/register_person", methods=["POST"])
 def register_person():
     """Register a new person using direct dlib approach - simplified and reliable"""
@@ -462,6 +661,123 @@ def reload_faces():
         return jsonify({"error": f"Failed to reload faces: {str(e)}"}), 500
 
 
+def check_admin_token(expected):
+    """Return an error response unless the request carries the expected token."""
+    if not expected:
+        return jsonify({"error": "Endpoint not found"}), 404
+
+    # Compare bytes: compare_digest rejects non-ASCII str with TypeError
+    token = request.headers.get("X-Admin-Token", "").encode("utf-8")
+    if not hmac.compare_digest(token, expected.encode("utf-8")):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return None
+
+
+@app.route("/reembed", methods=["POST"])
+def reembed_faces():
+    """Recompute known face encodings from the cached face chips."""
+    error = check_admin_token(ADMIN_TOKEN)
+    if error:
+        return error
+
+    try:
+        if recognizer is None:
+            return jsonify({"error": "Recognizer not initialized"}), 500
+
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "JSON object required"}), 400
+        num_jitters = data.get("num_jitters")
+        if num_jitters is not None and (
+            isinstance(num_jitters, bool)
+            or not isinstance(num_jitters, int)
+            or not 0 <= num_jitters <= MAX_NUM_JITTERS
+        ):
+            return jsonify(
+                {"error": f"num_jitters must be an integer from 0 to {MAX_NUM_JITTERS}"}
+            ), 400
+
+        started = time.perf_counter()
+        recognizer.reembed_gallery(gallery_jitters=num_jitters)
+
+        return jsonify(
+            {
+                "message": "Known faces re-embedded successfully",
+                "known_faces": len(recognizer.known_encodings),
+                "num_jitters": recognizer.gallery_jitters,
+                "duration_seconds": round(time.perf_counter() - started, 3),
+            }
+        )
+
+    except Exception as e:
+        logger.error(f"Error re-embedding faces: {e}")
+        return jsonify({"error": f"Failed to re-embed faces: {str(e)}"}), 500
+
+
+@app.route("/admin/profile", methods=["POST"])
+def profile_workers():
+    """Run a time-boxed profile across the worker threads.
+
+    mode=sample returns collapsed stacks for every thread; mode=cprofile
+    profiles the requests handled during the window and returns a pstats
+    report (format=text) or a binary pstats dump (format=pstats).
+    """
+    error = check_admin_token(PROFILING_TOKEN)
+    if error:
+        return error
+
+    try:
+        duration = float(request.args.get("seconds", 5))
+        interval = float(request.args.get("interval", 0.005))
+    except ValueError:
+        return jsonify({"error": "seconds and interval must be numbers"}), 400
+    if not 0 < duration <= PROFILING_MAX_SECONDS:
+        return jsonify(
+            {"error": f"seconds must be between 0 and {PROFILING_MAX_SECONDS:g}"}
+        ), 400
+    if not (
+        math.isfinite(interval)
+        and PROFILING_MIN_INTERVAL <= interval <= PROFILING_MAX_INTERVAL
+    ):
+        return jsonify(
+            {
+                "error": f"interval must be between {PROFILING_MIN_INTERVAL:g} "
+                f"and {PROFILING_MAX_INTERVAL:g} seconds"
+            }
+        ), 400
+
+    sort_by = request.args.get("sort", "cumulative")
+    if sort_by not in PROFILING_SORT_KEYS:
+        return jsonify(
+            {"error": f"sort must be one of: {', '.join(PROFILING_SORT_KEYS)}"}
+        ), 400
+
+    mode = request.args.get("mode", "sample")
+    if mode == "sample":
+        sampler = profiling.run_sampling_session(duration, interval=interval)
+        if sampler is None:
+            return jsonify({"error": "A profiling session is already running"}), 409
+        return Response(sampler.collapsed(), mimetype="text/plain")
+
+    if mode == "cprofile":
+        output_format = request.args.get("format", "text")
+        if output_format not in ("text", "pstats"):
+            return jsonify({"error": "format must be 'text' or 'pstats'"}), 400
+        session = profiling.run_cprofile_session(duration)
+        if session is None:
+            return jsonify({"error": "A profiling session is already running"}), 409
+        if output_format == "pstats":
+            return Response(
+                session.dump(),
+                mimetype="application/octet-stream",
+                headers={"Content-Disposition": "attachment; filename=profile.pstats"},
+            )
+        return Response(session.text_report(sort_by=sort_by), mimetype="text/plain")
+
+    return jsonify({"error": "mode must be 'sample' or 'cprofile'"}), 400
+
+
 @app.route("/static/<path:filename>")
 def static_files(filename):
     """Serve static files."""
@@ -484,6 +800,7 @@ if __name__ == "__main__":
     # Initialize systems
     init_recognizer()
     init_attendance_file()
+    attendance_rollup.load(attendance_file)
 
     # Get configuration from environment
     host = os.getenv("FLASK_HOST", "127.0.0.1")
@@ -0,0 +1,256 @@
+"""
+Incremental attendance rollups
+Per-day and per-person summaries kept up to date as attendance is logged
+"""
+
+import bisect
+import csv
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+class AttendanceRollup:
+    def __init__(self):
+        """Create an empty rollup; call load() to index an existing CSV file"""
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Drop all indexed rows"""
+        # date -> {"records": int, "people": {name: [first, last, count]}}
+        self.days = {}
+        # Sorted list of dates so range queries only touch the days they cover
+        self.dates = []
+        # date -> byte offset of the first CSV row logged on that date
+        self.day_offsets = {}
+        self.total_records = 0
+        # (device, inode, size, mtime) of the indexed file, None if never synced
+        self.file_state = None
+
+    def load(self, path):
+        """Build the rollup from an attendance CSV in a single pass"""
+        fresh = AttendanceRollup()
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                # Skip the header row; a truncated file may not have one
+                offset = 0
+                if f.readline().startswith(b"Name,"):
+                    offset = f.tell()
+                f.seek(offset)
+                for raw_line in iter(f.readline, b""):
+                    # Offsets count raw bytes, so undecodable rows are kept in place
+                    line = raw_line.decode("utf-8", errors="replace").strip()
+                    if line:
+                        try:
+                            name, timestamp, _ = next(csv.reader([line]))
+                            fresh.add(name, timestamp, offset)
+                        except (ValueError, StopIteration) as e:
+                            logger.warning(f"Skipping malformed attendance row: {e}")
+                    offset += len(raw_line)
+            fresh._sync(path)
+
+        # Swap in the finished index so readers never see a partial rebuild
+        with self._lock:
+            self.days = fresh.days
+            self.dates = fresh.dates
+            self.day_offsets = fresh.day_offsets
+            self.total_records = fresh.total_records
+            self.file_state = fresh.file_state
+
+        logger.info(
+            f"Attendance rollup loaded: {self.total_records} records "
+            f"over {len(self.dates)} days"
+        )
+
+    def _stat(self, path):
+        """Identity and size of path, or None if it does not exist"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _sync(self, path):
+        """Remember the current state of path after the index was built from it"""
+        state = self._stat(path)
+        with self._lock:
+            self.file_state = state
+
+    def refresh(self, path):
+        """Re-index path if it was rotated, truncated or edited since it was indexed
+
+        Returns True when the index was rebuilt.
+        """
+        with self._lock:
+            unchanged = self.file_state == self._stat(path)
+        if unchanged:
+            return False
+
+        logger.info(f"Attendance file {path} changed on disk, re-indexing")
+        self.load(path)
+        return True
+
+    def record_append(self, path, name, timestamp, offset, end):
+        """Index a row the caller appended to path between offset and end
+
+        The row is added incrementally only when it directly follows the
+        indexed data and nothing else changed the file; otherwise, e.g. when
+        another writer appended too, the whole file is re-indexed.
+        """
+        state = self._stat(path)
+        with self._lock:
+            indexed = self.file_state
+            contiguous = (
+                indexed is not None
+                and state is not None
+                and indexed[:2] == state[:2]
+                and indexed[2] == offset
+                and state[2] == end
+            )
+
+        if not contiguous:
+            logger.info(f"Attendance file {path} changed by another writer, re-indexing")
+            self.load(path)
+            return
+
+        self.add(name, timestamp, offset)
+        with self._lock:
+            self.file_state = state
+
+    def add(self, name, timestamp, offset):
+        """Record one attendance row written at the given byte offset"""
+        seen = datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+        date = timestamp[:10]
+
+        with self._lock:
+            day = self.days.get(date)
+            if day is None:
+                day = {"records": 0, "people": {}}
+                self.days[date] = day
+                self.day_offsets[date] = offset
+                bisect.insort(self.dates, date)
+
+            day["records"] += 1
+            person_day = day["people"].get(name)
+            if person_day is None:
+                day["people"][name] = [seen, seen, 1]
+            else:
+                person_day[0] = min(person_day[0], seen)
+                person_day[1] = max(person_day[1], seen)
+                person_day[2] += 1
+
+            self.total_records += 1
+
+    def _dates_in_range(self, start=None, end=None):
+        """Return the indexed dates between start and end inclusive"""
+        lo = 0 if start is None else bisect.bisect_left(self.dates, start)
+        hi = len(self.dates) if end is None else bisect.bisect_right(self.dates, end)
+        return self.dates[lo:hi]
+
+    def daily_summary(self, start=None, end=None):
+        """Headcount and record count for each day in the range"""
+        with self._lock:
+            return [
+                {
+                    "date": date,
+                    "headcount": len(self.days[date]["people"]),
+                    "records": self.days[date]["records"],
+                }
+                for date in self._dates_in_range(start, end)
+            ]
+
+    def person_summary(self, start=None, end=None, name=None):
+        """First/last seen, days present and hours present per person in the range"""
+        summary = {}
+
+        with self._lock:
+            for date in self._dates_in_range(start, end):
+                for person, (first, last, count) in self.days[date]["people"].items():
+                    if name and name.lower() not in person.lower():
+                        continue
+                    entry = summary.get(person)
+                    if entry is None:
+                        entry = {
+                            "name": person,
+                            "first_seen": first,
+                            "last_seen": last,
+                            "days_present": 0,
+                            "hours_present": 0.0,
+                            "records": 0,
+                        }
+                        summary[person] = entry
+                    entry["first_seen"] = min(entry["first_seen"], first)
+                    entry["last_seen"] = max(entry["last_seen"], last)
+                    entry["days_present"] += 1
+                    entry["hours_present"] += (last - first).total_seconds() / 3600
+                    entry["records"] += count
+
+        people = []
+        for entry in sorted(summary.values(), key=lambda e: e["name"]):
+            entry["first_seen"] = entry["first_seen"].strftime(TIMESTAMP_FORMAT)
+            entry["last_seen"] = entry["last_seen"].strftime(TIMESTAMP_FORMAT)
+            entry["hours_present"] = round(entry["hours_present"], 2)
+            people.append(entry)
+        return people
+
+    def start_offset(self, start=None):
+        """Byte offset of the first row on or after start, or None if there is none"""
+        with self._lock:
+            index = 0 if start is None else bisect.bisect_left(self.dates, start)
+            if index == len(self.dates):
+                return None
+            return self.day_offsets[self.dates[index]]
+
+
+def iter_export(path, offset, end=None, fmt="csv"):
+    """Stream attendance rows from offset up to end as CSV or NDJSON chunks
+
+    Rows are appended in timestamp order, so reading stops at the first
+    row dated after end instead of scanning the rest of the file.
+    """
+    buffer = []
+    size = 0
+
+    if fmt == "csv":
+        header = "Name,Timestamp,Confidence\n"
+        buffer.append(header)
+        size += len(header)
+
+    if offset is not None:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw_line in f:
+                line = raw_line.decode("utf-8", errors="replace").strip()
+                if not line:
+                    continue
+                row = next(csv.reader([line]))
+                if len(row) != 3:
+                    continue
+                if end is not None and row[1][:10] > end:
+                    break
+
+                if fmt == "csv":
+                    chunk = line + "\n"
+                else:
+                    chunk = json.dumps(
+                        {"Name": row[0], "Timestamp": row[1], "Confidence": row[2]}
+                    ) + "\n"
+                buffer.append(chunk)
+                size += len(chunk)
+
+                if size >= EXPORT_CHUNK_SIZE:
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+
+    if buffer:
+        yield "".join(buffer)
@@ -0,0 +1,180 @@
+"""
+On-demand profiling helpers for the Flask API
+Time-boxed sampling and cProfile sessions with no cost while idle
+"""
+
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# Only one profiling session may run per process at a time
+_session_lock = threading.Lock()
+
+
+class StackSampler:
+    def __init__(self, interval=0.005):
+        """Periodically sample the stacks of all other threads in the process"""
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def _collapse(self, frame):
+        """Render a frame chain as a semicolon separated root-to-leaf stack"""
+        parts = []
+        while frame is not None:
+            code = frame.f_code
+            parts.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(parts))
+
+    def run(self, duration):
+        """Sample every thread except the caller until duration elapses"""
+        own_ident = threading.get_ident()
+        names = {}
+        deadline = time.perf_counter() + duration
+
+        while time.perf_counter() < deadline:
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                thread_name = names.get(ident, str(ident))
+                self.stacks[f"{thread_name};{self._collapse(frame)}"] += 1
+
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Return stacks in the collapsed format used by flamegraph tools"""
+        return "\n".join(
+            f"{stack} {count}" for stack, count in self.stacks.most_common()
+        )
+
+
+class RequestProfiler:
+    def __init__(self):
+        """Aggregate cProfile data across requests handled during a session"""
+        self.active = False
+        self.requests = 0
+        self.skipped = 0
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def start_request(self):
+        """Return an enabled profiler for the current request, or None when idle"""
+        if not self.active:
+            return None
+        profile = cProfile.Profile()
+        # Up to Python 3.11 cProfile hooks are per-thread, so each worker
+        # thread can profile its own request. From 3.12 cProfile uses the
+        # process-wide sys.monitoring and a second concurrent enable()
+        # raises ValueError; those requests are skipped rather than failed.
+        try:
+            profile.enable()
+        except ValueError:
+            with self._lock:
+                self.skipped += 1
+            return None
+        return profile
+
+    def finish_request(self, profile):
+        """Disable a request profiler and merge its stats into the session"""
+        profile.disable()
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.requests += 1
+
+    def run(self, duration):
+        """Collect request profiles for duration seconds"""
+        self.active = True
+        try:
+            time.sleep(duration)
+        finally:
+            self.active = False
+
+    def text_report(self, sort_by="cumulative", limit=50):
+        """Return a human readable pstats report"""
+        with self._lock:
+            if self._stats is None:
+                return "No requests were profiled\n"
+            stream = io.StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats(sort_by).print_stats(limit)
+            return stream.getvalue()
+
+    def dump(self):
+        """Return a binary pstats dump loadable with pstats.Stats(filename)"""
+        with self._lock:
+            if self._stats is None:
+                return b""
+            return marshal.dumps(self._stats.stats)
+
+
+# Session currently collecting request profiles; None while idle
+_active_profiler = None
+
+
+def start_request_profile():
+    """Begin profiling the current request if a cProfile session is running"""
+    session = _active_profiler
+    if session is None:
+        return None
+    profile = session.start_request()
+    if profile is None:
+        return None
+    return session, profile
+
+
+def finish_request_profile(handle):
+    """Finish a request profile started with start_request_profile"""
+    session, profile = handle
+    session.finish_request(profile)
+
+
+def run_sampling_session(duration, interval=0.005):
+    """Run a stack sampling session and return the sampler, or None if busy"""
+    if not _session_lock.acquire(blocking=False):
+        return None
+    try:
+        logger.info(f"Starting stack sampling for {duration:.1f}s")
+        sampler = StackSampler(interval=interval)
+        sampler.run(duration)
+        logger.info(f"Stack sampling finished: {sampler.samples} samples")
+        return sampler
+    finally:
+        _session_lock.release()
+
+
+def run_cprofile_session(duration):
+    """Profile all requests for duration seconds and return the profiler, or None if busy"""
+    global _active_profiler
+    if not _session_lock.acquire(blocking=False):
+        return None
+    try:
+        logger.info(f"Starting request cProfile for {duration:.1f}s")
+        session = RequestProfiler()
+        _active_profiler = session
+        try:
+            session.run(duration)
+        finally:
+            _active_profiler = None
+        logger.info(
+            f"Request cProfile finished: {session.requests} requests "
+            f"({session.skipped} skipped while another profiler was active)"
+        )
+        return session
+    finally:
+        _session_lock.release()
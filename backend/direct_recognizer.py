@@ -10,16 +10,44 @@ import os
 import logging
 from PIL import Image
 import io
+import json
 import base64
+import tempfile
+import threading
+import time
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Aligned face chips, matching what compute_face_descriptor extracts internally
+CHIP_SIZE = 150
+CHIP_PADDING = 0.25
+CHIP_STORE_VERSION = 2
+CHIP_STORE_PREFIX = "face_chips-"
+CHIP_INDEX_FILE = "face_chips.json"
+CHIP_SWEEP_GRACE_SECONDS = 600
+EMBED_BATCH_SIZE = 64
+
+# (encodings, names, offsets) snapshot; replaced as a whole, never mutated
+EMPTY_GALLERY = (np.empty((0, 128)), (), np.empty(0, dtype=np.intp))
+
+
+def read_chip(ref):
+    """Resolve a (source, row) chip reference; row is None for a standalone chip"""
+    source, row = ref
+    return source if row is None else source[row]
+
+
 class DirectDlibRecognizer:
-    def __init__(self, models_dir, known_faces_dir):
+    def __init__(self, models_dir, known_faces_dir, gallery_jitters=0):
         """Initialize the direct dlib recognizer"""
         self.models_dir = models_dir
         self.known_faces_dir = known_faces_dir
+        # Jitters only apply when embedding the gallery; live queries use none
+        self.gallery_jitters = gallery_jitters
+        
+        # Serializes gallery rebuilds and chip store writes across request threads
+        self.store_lock = threading.RLock()
         
         # Load dlib models
         predictor_path = os.path.join(models_dir, "shape_predictor_68_face_landmarks.dat")
@@ -38,29 +66,34 @@ class DirectDlibRecognizer:
         
         # Load known faces
         self.known_encodings = {}
+        self.gallery = EMPTY_GALLERY
         self.load_known_faces()
         
+    def get_face_landmarks(self, image):
+        """Detect the first face in image and return its landmarks"""
+        # Ensure image is in the right format
+        if len(image.shape) == 3 and image.shape[2] == 3:
+            # RGB image - convert to grayscale for detection
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        else:
+            gray = image
+            
+        # Detect faces
+        faces = self.detector(gray, 1)
+        
+        if len(faces) == 0:
+            return None
+            
+        # Use the first detected face and get facial landmarks
+        return self.predictor(gray, faces[0])
+    
     def get_face_encoding(self, image):
         """Get face encoding from image using dlib"""
         try:
-            # Ensure image is in the right format
-            if len(image.shape) == 3 and image.shape[2] == 3:
-                # RGB image - convert to grayscale for detection
-                gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-            else:
-                gray = image
-                
-            # Detect faces
-            faces = self.detector(gray, 1)
+            landmarks = self.get_face_landmarks(image)
             
-            if len(faces) == 0:
+            if landmarks is None:
                 return None
-                
-            # Use the first detected face
-            face = faces[0]
-            
-            # Get facial landmarks
-            landmarks = self.predictor(gray, face)
             
             # Get face encoding
             face_encoding = self.face_rec_model.compute_face_descriptor(image, landmarks)
@@ -71,30 +104,225 @@ class DirectDlibRecognizer:
             logger.error(f"Error getting face encoding: {e}")
             return None
     
-    def load_known_faces(self):
-        """Load all known faces from directory"""
-        self.known_encodings = {}
+    def get_face_chip(self, image):
+        """Get the aligned 150x150 face chip for the first face in image"""
+        try:
+            landmarks = self.get_face_landmarks(image)
+            
+            if landmarks is None:
+                return None
+            
+            return dlib.get_face_chip(image, landmarks, size=CHIP_SIZE, padding=CHIP_PADDING)
+            
+        except Exception as e:
+            logger.error(f"Error getting face chip: {e}")
+            return None
+    
+    def embed_chips(self, chip_refs):
+        """Compute gallery descriptors for (source, row) chip references in batches"""
+        encodings = []
+        
+        for start in range(0, len(chip_refs), EMBED_BATCH_SIZE):
+            batch = [np.ascontiguousarray(read_chip(ref))
+                     for ref in chip_refs[start:start + EMBED_BATCH_SIZE]]
+            descriptors = self.face_rec_model.compute_face_descriptor(batch, self.gallery_jitters)
+            encodings.extend(np.array(descriptor) for descriptor in descriptors)
+        
+        return encodings
+    
+    def load_chip_store(self):
+        """Load the packed chip store, returning (chips, entries) or (None, [])"""
+        index_path = os.path.join(self.known_faces_dir, CHIP_INDEX_FILE)
+        
+        if not os.path.exists(index_path):
+            return None, []
+        
+        try:
+            with open(index_path, "r") as f:
+                index = json.load(f)
+            
+            if (index.get("version") != CHIP_STORE_VERSION
+                    or index.get("chip_size") != CHIP_SIZE
+                    or index.get("padding") != CHIP_PADDING):
+                logger.info("Chip store format changed, rebuilding")
+                return None, []
+            
+            entries = index["entries"]
+            if not entries:
+                return np.empty((0, CHIP_SIZE, CHIP_SIZE, 3), dtype=np.uint8), entries
+            
+            # The index names the chip file it was written with, so it is
+            # never paired with chips from a different save
+            store_path = os.path.join(self.known_faces_dir, index["store"])
+            chips = np.load(store_path, mmap_mode="r")
+            
+            if chips.shape != (len(entries), CHIP_SIZE, CHIP_SIZE, 3):
+                logger.warning("Chip store does not match its index, rebuilding")
+                return None, []
+            
+            return chips, entries
+            
+        except Exception as e:
+            logger.warning(f"Could not load chip store: {e}")
+            return None, []
+    
+    def save_chip_store(self, chip_refs, entries):
+        """Write chips as one packed uint8 array (memory-mapped on load) plus a JSON index
+        
+        Rows are streamed into a new uniquely named file, reading unchanged
+        chips straight from the mapped store, and the index is replaced
+        last so swapping it is the single step that publishes them.
+        """
+        index_path = os.path.join(self.known_faces_dir, CHIP_INDEX_FILE)
+        
+        fd, store_path = tempfile.mkstemp(
+            prefix=CHIP_STORE_PREFIX, suffix=".npy", dir=self.known_faces_dir
+        )
+        os.close(fd)
+        
+        if chip_refs:
+            packed = np.lib.format.open_memmap(
+                store_path, mode="w+", dtype=np.uint8,
+                shape=(len(chip_refs), CHIP_SIZE, CHIP_SIZE, 3)
+            )
+            for row, ref in enumerate(chip_refs):
+                packed[row] = read_chip(ref)
+            packed.flush()
+            del packed
+        else:
+            np.save(store_path, np.empty((0, CHIP_SIZE, CHIP_SIZE, 3), dtype=np.uint8))
+        
+        fd, index_tmp = tempfile.mkstemp(
+            prefix=CHIP_INDEX_FILE, suffix=".tmp", dir=self.known_faces_dir
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump({
+                "version": CHIP_STORE_VERSION,
+                "chip_size": CHIP_SIZE,
+                "padding": CHIP_PADDING,
+                "store": os.path.basename(store_path),
+                "entries": entries
+            }, f)
+        
+        os.replace(index_tmp, index_path)
+        logger.info(f"Saved chip store with {len(entries)} chips")
+        
+        self.sweep_chip_files(os.path.basename(store_path))
+    
+    def sweep_chip_files(self, current_store):
+        """Delete chip files and index temp files the current index no longer uses
+        
+        Files younger than CHIP_SWEEP_GRACE_SECONDS are left alone, since
+        another replica sharing the directory may still be writing them.
+        """
+        cutoff = time.time() - CHIP_SWEEP_GRACE_SECONDS
         
+        for filename in os.listdir(self.known_faces_dir):
+            stale_store = (filename.startswith(CHIP_STORE_PREFIX)
+                           and filename.endswith(".npy")
+                           and filename != current_store)
+            stale_index = (filename.startswith(CHIP_INDEX_FILE)
+                           and filename.endswith(".tmp"))
+            if not (stale_store or stale_index):
+                continue
+            
+            path = os.path.join(self.known_faces_dir, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                # Still mapped elsewhere or already removed; retry on the next save
+                pass
+    
+    def reembed_gallery(self, gallery_jitters=None):
+        """Recompute known encodings from the chip store as of the last load_known_faces"""
+        with self.store_lock:
+            if gallery_jitters is not None:
+                self.gallery_jitters = gallery_jitters
+            
+            chips, entries = self.load_chip_store()
+            
+            if chips is None:
+                # No usable store yet; fall back to a full scan which also builds it
+                self.load_known_faces()
+                return
+            
+            encodings = self.embed_chips([(chips, row) for row in range(len(entries))])
+            
+            known_encodings = {}
+            for entry, encoding in zip(entries, encodings):
+                known_encodings.setdefault(entry["person"], []).append(encoding)
+            
+            self.known_encodings = known_encodings
+            self.build_gallery()
+            logger.info(f"Re-embedded {len(encodings)} chips with gallery_jitters={self.gallery_jitters}")
+    
+    def load_known_faces(self, new_chips=None):
+        """Load all known faces from directory
+        
+        Aligned chips are cached in a packed store next to the images, so
+        only new or modified photos go through decode, detection and
+        landmarks; everything else is re-embedded straight from its chip.
+        new_chips maps (person, filename) to chips the caller already
+        extracted, as enrollment does for the photos it just saved.
+        """
+        with self.store_lock:
+            self._load_known_faces(new_chips or {})
+    
+    def _load_known_faces(self, new_chips):
+        """Scan known_faces_dir and rebuild encodings; caller holds store_lock"""
         if not os.path.exists(self.known_faces_dir):
             os.makedirs(self.known_faces_dir, exist_ok=True)
             logger.info("Created known_faces directory")
+            self.known_encodings = {}
+            self.build_gallery()
             return
         
-        total_encodings = 0
+        cached_chips, cached_entries = self.load_chip_store()
+        cached_rows = {
+            (entry["person"], entry["file"]): (row, entry)
+            for row, entry in enumerate(cached_entries)
+        }
+        
+        # (source, row) references: cached chips stay in the memory-mapped
+        # store and are only read batch by batch when embedding or saving
+        chip_refs = []
+        entries = []
+        detected = 0
         
-        for person_name in os.listdir(self.known_faces_dir):
+        for person_name in sorted(os.listdir(self.known_faces_dir)):
             person_dir = os.path.join(self.known_faces_dir, person_name)
             
             if not os.path.isdir(person_dir):
                 continue
-                
-            person_encodings = []
             
-            for filename in os.listdir(person_dir):
+            for filename in sorted(os.listdir(person_dir)):
                 if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
                     img_path = os.path.join(person_dir, filename)
                     
                     try:
+                        stat = os.stat(img_path)
+                        entry = {
+                            "person": person_name,
+                            "file": filename,
+                            "mtime": stat.st_mtime,
+                            "size": stat.st_size
+                        }
+                        
+                        # Chip extracted by the caller for a freshly saved photo
+                        chip = new_chips.get((person_name, filename))
+                        if chip is not None:
+                            chip_refs.append((chip, None))
+                            entries.append(entry)
+                            continue
+                        
+                        # Reuse the cached chip if the photo is unchanged
+                        cached = cached_rows.get((person_name, filename))
+                        if cached is not None and cached[1] == entry:
+                            chip_refs.append((cached_chips, cached[0]))
+                            entries.append(entry)
+                            continue
+                        
                         # Load image
                         image = cv2.imread(img_path)
                         if image is None:
@@ -104,26 +332,88 @@ class DirectDlibRecognizer:
                         # Convert BGR to RGB
                         image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
                         
-                        # Get encoding
-                        encoding = self.get_face_encoding(image_rgb)
+                        # Get aligned face chip
+                        chip = self.get_face_chip(image_rgb)
                         
-                        if encoding is not None:
-                            person_encodings.append(encoding)
-                            total_encodings += 1
+                        if chip is not None:
+                            chip_refs.append((chip, None))
+                            entries.append(entry)
+                            detected += 1
                         else:
                             logger.warning(f"No face detected in {img_path}")
                             
                     except Exception as e:
                         logger.error(f"Error processing {img_path}: {e}")
-            
-            if person_encodings:
-                self.known_encodings[person_name] = person_encodings
-                logger.info(f"Loaded {len(person_encodings)} encodings for {person_name}")
         
-        logger.info(f"Total known faces loaded: {len(self.known_encodings)} people with {total_encodings} encodings")
+        # Embed every chip in batched passes
+        encodings = self.embed_chips(chip_refs)
+        
+        # Save after embedding so the old mapped store is no longer needed
+        if entries != cached_entries:
+            try:
+                self.save_chip_store(chip_refs, entries)
+            except Exception as e:
+                logger.error(f"Could not save chip store: {e}")
+        
+        known_encodings = {}
+        for entry, encoding in zip(entries, encodings):
+            known_encodings.setdefault(entry["person"], []).append(encoding)
+        
+        for person_name, person_encodings in known_encodings.items():
+            logger.info(f"Loaded {len(person_encodings)} encodings for {person_name}")
+        
+        self.known_encodings = known_encodings
+        self.build_gallery()
+        logger.info(f"Detected faces in {detected} images, reused {len(chip_refs) - detected} stored chips")
+        logger.info(f"Total known faces loaded: {len(known_encodings)} people with {len(encodings)} encodings")
     
-    def recognize_face(self, image, tolerance=0.6):
-        """Recognize face in image"""
+    def build_gallery(self):
+        """Pack known encodings into one matrix grouped contiguously by person
+        
+        The matrix, names and offsets are published together in a single
+        assignment so concurrent recognitions never mix old and new data.
+        """
+        names = tuple(name for name, encodings in self.known_encodings.items() if encodings)
+        
+        if not names:
+            self.gallery = EMPTY_GALLERY
+            return
+        
+        counts = [len(self.known_encodings[name]) for name in names]
+        encodings = np.vstack([np.asarray(self.known_encodings[name]) for name in names])
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.intp)
+        encodings.setflags(write=False)
+        offsets.setflags(write=False)
+        
+        self.gallery = (encodings, names, offsets)
+    
+    def match_candidates(self, encoding, top_k=1):
+        """Return the top_k identities as (name, min distance) pairs, closest first"""
+        # Read the snapshot once; build_gallery may replace it concurrently
+        encodings, names, offsets = self.gallery
+        
+        if len(names) == 0:
+            return []
+        
+        # One vectorized query over the whole gallery, then per-person minimum
+        distances = np.linalg.norm(encodings - encoding, axis=1)
+        person_distances = np.minimum.reduceat(distances, offsets)
+        
+        k = min(max(1, top_k), len(person_distances))
+        if k < len(person_distances):
+            nearest = np.argpartition(person_distances, k - 1)[:k]
+        else:
+            nearest = np.arange(len(person_distances))
+        nearest = nearest[np.argsort(person_distances[nearest])]
+        
+        return [(names[i], float(person_distances[i])) for i in nearest]
+    
+    def recognize_face(self, image, tolerance=0.6, top_k=1, min_margin=0.0):
+        """Recognize face in image
+        
+        The best identity is accepted only when its distance is below
+        tolerance and it beats the runner-up identity by at least min_margin.
+        """
         try:
             # Get encoding for unknown face
             unknown_encoding = self.get_face_encoding(image)
@@ -136,34 +426,66 @@ class DirectDlibRecognizer:
                     "registration_required": False
                 }
             
-            # Check against known faces
+            # Always fetch the runner-up so the margin can be computed
+            matches = self.match_candidates(unknown_encoding, top_k=max(top_k, 2))
+            
+            candidates = [
+                {
+                    "name": name,
+                    "distance": distance,
+                    "confidence": max(0.0, 1.0 - (distance / tolerance))
+                }
+                for name, distance in matches[:max(1, top_k)]
+            ]
+            
             best_match = None
             best_distance = float('inf')
+            margin = None
             
-            for name, encodings in self.known_encodings.items():
-                for known_encoding in encodings:
-                    # Calculate distance
-                    distance = np.linalg.norm(known_encoding - unknown_encoding)
-                    
-                    if distance < tolerance and distance < best_distance:
-                        best_distance = distance
-                        best_match = name
+            if matches:
+                best_match, best_distance = matches[0]
+                if len(matches) > 1:
+                    margin = matches[1][1] - best_distance
+            
+            ambiguous = (
+                best_distance < tolerance
+                and margin is not None
+                and margin < min_margin
+            )
             
-            if best_match:
+            if best_distance < tolerance and not ambiguous:
                 confidence = max(0.0, 1.0 - (best_distance / tolerance))
                 return {
                     "face_detected": True,
                     "name": best_match,
                     "confidence": confidence,
                     "distance": best_distance,
+                    "margin": margin,
+                    "margin_confidence": None if margin is None else min(1.0, margin / tolerance),
+                    "candidates": candidates,
                     "registration_required": False
                 }
+            elif ambiguous:
+                # Known face, but too close to call between identities
+                return {
+                    "face_detected": True,
+                    "name": None,
+                    "confidence": 0.0,
+                    "distance": best_distance,
+                    "margin": margin,
+                    "candidates": candidates,
+                    "ambiguous": True,
+                    "registration_required": False,
+                    "message": "Ambiguous match between known faces"
+                }
             else:
                 # Unknown face - registration required
                 return {
                     "face_detected": True,
                     "name": None,
                     "confidence": 0.0,
+                    "margin": margin,
+                    "candidates": candidates,
                     "registration_required": True,
                     "message": "Unknown face detected"
                 }
@@ -196,9 +518,10 @@ class DirectDlibRecognizer:
             
             os.makedirs(person_dir, exist_ok=True)
             
-            # Process and save images
+            # Process and save images, keeping each aligned chip for the store
             saved_count = 0
             valid_faces = 0
+            new_chips = {}
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             
             for i, image_data in enumerate(images):
@@ -214,9 +537,9 @@ class DirectDlibRecognizer:
                         continue
                     
                     # Check if face is detected
-                    encoding = self.get_face_encoding(image_array)
+                    chip = self.get_face_chip(image_array)
                     
-                    if encoding is not None:
+                    if chip is not None:
                         # Save image
                         filename = f"{person_name}_{timestamp}_{i+1:02d}.jpg"
                         img_path = os.path.join(person_dir, filename)
@@ -224,6 +547,7 @@ class DirectDlibRecognizer:
                         # Convert RGB to BGR for cv2
                         image_bgr = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
                         cv2.imwrite(img_path, image_bgr)
+                        new_chips[(person_name, filename)] = chip
                         
                         saved_count += 1
                         valid_faces += 1
@@ -245,8 +569,8 @@ class DirectDlibRecognizer:
                     "error": "No valid faces detected in any image"
                 }
             
-            # Reload known faces to include new person
-            self.load_known_faces()
+            # Reload known faces to include new person, reusing the chips above
+            self.load_known_faces(new_chips=new_chips)
             
             return {
                 "success": True,
@@ -262,10 +586,10 @@ class DirectDlibRecognizer:
             return {"success": False, "error": str(e)}
 
 
-def create_direct_recognizer(models_dir, known_faces_dir):
+def create_direct_recognizer(models_dir, known_faces_dir, gallery_jitters=0):
     """Create and return a direct dlib recognizer instance"""
     try:
-        recognizer = DirectDlibRecognizer(models_dir, known_faces_dir)
+        recognizer = DirectDlibRecognizer(models_dir, known_faces_dir, gallery_jitters)
         return recognizer
     except Exception as e:
         logger.error(f"Failed to create direct recognizer: {e}")
@@ -9,9 +9,28 @@ class AttendanceSystem {
         this.canvas = document.getElementById('canvas');
         this.ctx = this.canvas.getContext('2d');
         this.isCapturing = false;
-        this.captureInterval = null;
+        this.captureTimer = null;
+        this.captureSession = 0;
         this.threshold = 0.6;
         this.interval = 5; // seconds
+
+        // Change detection on a downsampled grayscale copy of the video
+        this.motionCanvas = document.createElement('canvas');
+        this.motionCanvas.width = 64;
+        this.motionCanvas.height = 48;
+        this.motionCtx = this.motionCanvas.getContext('2d', { willReadFrequently: true });
+        this.motionCheckMs = 250;
+        this.motionPixelThreshold = 25; // per-pixel luminance difference (0-255)
+        this.motionFraction = 0.02; // share of changed pixels that counts as a change
+        this.motionResetFraction = 0.15; // change large enough to cancel the no-face backoff
+        this.lastUploadFrame = null;
+        this.lastUploadTime = 0;
+
+        // Backoff state driven by server hints and recent results
+        this.serverHintMs = 0;
+        this.serverHintNoFace = false;
+        this.noFaceStreak = 0;
+        this.maxBackoffMs = 30000;
         
         this.initializeElements();
         this.initializeCamera();
@@ -181,15 +200,79 @@ class AttendanceSystem {
         this.toggleBtn.innerHTML = '<i class="fas fa-stop"></i> Stop Auto Capture';
         this.toggleBtn.className = 'btn btn-danger btn-lg me-2';
         
-        this.updateStatus(`Auto capture started (every ${this.interval}s)`, 'info');
+        this.updateStatus(`Auto capture started (every ${this.interval}s when the scene changes)`, 'info');
         
         // Start immediate capture
         this.captureAndRecognize();
         
-        // Set up interval
-        this.captureInterval = setInterval(() => {
-            this.captureAndRecognize();
-        }, this.interval * 1000);
+        // Poll for scene changes; each session owns its own timer chain
+        const session = ++this.captureSession;
+        this.captureTimer = setTimeout(() => this.autoCaptureTick(session), this.motionCheckMs);
+    }
+
+    async autoCaptureTick(session) {
+        if (!this.isCapturing || session !== this.captureSession) {
+            return;
+        }
+
+        const change = this.changedFraction(this.sampleFrame());
+
+        // Someone walking in should not wait out backoff earned by an empty scene
+        if (change > this.motionResetFraction && this.noFaceStreak > 0) {
+            this.noFaceStreak = 0;
+            if (this.serverHintNoFace) {
+                this.serverHintMs = 0;
+            }
+        }
+
+        const due = Date.now() - this.lastUploadTime >= this.nextUploadDelay();
+        if (due && change > this.motionFraction) {
+            await this.captureAndRecognize();
+        }
+
+        if (this.isCapturing && session === this.captureSession) {
+            this.captureTimer = setTimeout(() => this.autoCaptureTick(session), this.motionCheckMs);
+        }
+    }
+
+    sampleFrame() {
+        // Grayscale thumbnail of the current video frame
+        const { width, height } = this.motionCanvas;
+        this.motionCtx.drawImage(this.video, 0, 0, width, height);
+        const pixels = this.motionCtx.getImageData(0, 0, width, height).data;
+        const gray = new Uint8Array(width * height);
+        for (let i = 0, j = 0; i < pixels.length; i += 4, j++) {
+            gray[j] = (pixels[i] * 77 + pixels[i + 1] * 150 + pixels[i + 2] * 29) >> 8;
+        }
+        return gray;
+    }
+
+    changedFraction(frame) {
+        // Share of pixels that differ noticeably from the last uploaded frame,
+        // so a small or distant subject still registers as a change
+        if (!this.lastUploadFrame) {
+            return 1;
+        }
+        let changed = 0;
+        for (let i = 0; i < frame.length; i++) {
+            if (Math.abs(frame[i] - this.lastUploadFrame[i]) > this.motionPixelThreshold) {
+                changed++;
+            }
+        }
+        return changed / frame.length;
+    }
+
+    nextUploadDelay() {
+        // Double the base interval for each consecutive frame without a face
+        const backoff = 2 ** Math.min(this.noFaceStreak, 3);
+        const delay = Math.max(this.interval * 1000 * backoff, this.serverHintMs);
+        return Math.min(delay, this.maxBackoffMs);
+    }
+
+    updateCaptureHints(result) {
+        this.serverHintMs = result.next_capture_ms || 0;
+        this.serverHintNoFace = !result.face_detected;
+        this.noFaceStreak = result.face_detected ? 0 : this.noFaceStreak + 1;
     }
 
     stopAutoCapture() {
@@ -197,9 +280,9 @@ class AttendanceSystem {
         this.toggleBtn.innerHTML = '<i class="fas fa-play"></i> Start Auto Capture';
         this.toggleBtn.className = 'btn btn-success btn-lg me-2';
         
-        if (this.captureInterval) {
-            clearInterval(this.captureInterval);
-            this.captureInterval = null;
+        if (this.captureTimer) {
+            clearTimeout(this.captureTimer);
+            this.captureTimer = null;
         }
         
         this.updateStatus('Auto capture stopped', 'warning');
@@ -207,6 +290,10 @@ class AttendanceSystem {
 
     async captureAndRecognize() {
         try {
+            // Reference frame for change detection, kept only once the upload succeeds
+            const frame = this.sampleFrame();
+            this.lastUploadTime = Date.now();
+
             // Draw video frame to canvas
             this.ctx.drawImage(this.video, 0, 0, 640, 480);
             
@@ -229,6 +316,8 @@ class AttendanceSystem {
             const result = await response.json();
             
             if (response.ok) {
+                this.lastUploadFrame = frame;
+                this.updateCaptureHints(result);
                 this.displayResult(result);
                 
                 // Refresh attendance if someone was recognized
@@ -242,6 +331,14 @@ class AttendanceSystem {
         } catch (error) {
             console.error('Capture failed:', error);
             this.updateStatus(`Error: ${error.message}`, 'danger');
+
+            // Retry this scene even if nothing moves, but back off first
+            this.lastUploadFrame = null;
+            this.serverHintNoFace = false;
+            this.serverHintMs = Math.min(
+                Math.max(this.serverHintMs, this.interval * 1000) * 2,
+                this.maxBackoffMs
+            );
         }
     }
 
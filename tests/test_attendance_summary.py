@@ -0,0 +1,240 @@
+"""
+Tests for the incremental attendance rollup and streaming export
+"""
+
+import csv
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "api"))
+from attendance_summary import AttendanceRollup, iter_export
+
+ROWS = [
+    ("Alice", "2025-07-15 09:00:00", "0.8000"),
+    ("Bob", "2025-07-15 09:30:00", "0.7000"),
+    ("Alice", "2025-07-15 17:00:00", "0.8100"),
+    ("Smith, John", "2025-07-16 08:00:00", "0.6500"),
+    ('Dana "DJ" Lee', "2025-07-16 10:00:00", "0.6000"),
+    ("Alice", "2025-07-17 10:00:00", "0.9000"),
+    ("Alice", "2025-07-17 12:00:00", "0.9100"),
+]
+
+
+def write_rows(path, rows):
+    """Append rows the same way log_attendance does, returning their offsets"""
+    offsets = []
+    with open(path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(["Name", "Timestamp", "Confidence"])
+        for row in rows:
+            offsets.append(f.tell())
+            writer.writerow(row)
+    return offsets
+
+
+def log_row(rollup, path, row):
+    """Append and index one row the way log_attendance does"""
+    rollup.refresh(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.writer(f)
+        if f.tell() == 0:
+            writer.writerow(["Name", "Timestamp", "Confidence"])
+        offset = f.tell()
+        writer.writerow(row)
+        end = f.tell()
+    rollup.record_append(path, row[0], row[1], offset, end)
+
+
+@pytest.fixture
+def attendance_path(tmp_path):
+    path = tmp_path / "attendance.csv"
+    write_rows(path, ROWS)
+    return str(path)
+
+
+def test_load_matches_incremental_add(tmp_path):
+    path = str(tmp_path / "attendance.csv")
+    incremental = AttendanceRollup()
+    for row, offset in zip(ROWS, write_rows(path, ROWS)):
+        incremental.add(row[0], row[1], offset)
+
+    loaded = AttendanceRollup()
+    loaded.load(path)
+
+    assert loaded.dates == incremental.dates
+    assert loaded.days == incremental.days
+    assert loaded.day_offsets == incremental.day_offsets
+    assert loaded.total_records == len(ROWS)
+
+
+def test_daily_summary_range_is_inclusive(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    assert rollup.daily_summary() == [
+        {"date": "2025-07-15", "headcount": 2, "records": 3},
+        {"date": "2025-07-16", "headcount": 2, "records": 2},
+        {"date": "2025-07-17", "headcount": 1, "records": 2},
+    ]
+    assert [d["date"] for d in rollup.daily_summary("2025-07-16", "2025-07-17")] == [
+        "2025-07-16",
+        "2025-07-17",
+    ]
+    assert [d["date"] for d in rollup.daily_summary(end="2025-07-15")] == ["2025-07-15"]
+    assert rollup.daily_summary("2025-07-18") == []
+    assert rollup.daily_summary("2025-07-01", "2025-07-14") == []
+
+
+def test_person_summary_hours_and_quoted_names(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    people = {p["name"]: p for p in rollup.person_summary()}
+    assert set(people) == {"Alice", "Bob", "Smith, John", 'Dana "DJ" Lee'}
+
+    alice = people["Alice"]
+    assert alice["first_seen"] == "2025-07-15 09:00:00"
+    assert alice["last_seen"] == "2025-07-17 12:00:00"
+    assert alice["days_present"] == 2
+    assert alice["hours_present"] == 10.0
+    assert alice["records"] == 4
+
+    filtered = rollup.person_summary("2025-07-16", "2025-07-16", name="smith")
+    assert [p["name"] for p in filtered] == ["Smith, John"]
+
+
+def test_start_offset(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    assert rollup.start_offset() == rollup.day_offsets["2025-07-15"]
+    assert rollup.start_offset("2025-07-16") == rollup.day_offsets["2025-07-16"]
+    assert rollup.start_offset("2025-07-15T") == rollup.day_offsets["2025-07-16"]
+    assert rollup.start_offset("2025-07-18") is None
+
+
+def test_csv_export_window(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    offset = rollup.start_offset("2025-07-16")
+    output = "".join(iter_export(attendance_path, offset, "2025-07-16", "csv"))
+    rows = list(csv.reader(output.splitlines()))
+
+    assert rows[0] == ["Name", "Timestamp", "Confidence"]
+    assert [tuple(r) for r in rows[1:]] == [ROWS[3], ROWS[4]]
+
+
+def test_ndjson_export_window(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    offset = rollup.start_offset("2025-07-17")
+    output = "".join(iter_export(attendance_path, offset, None, "ndjson"))
+    records = [json.loads(line) for line in output.splitlines()]
+
+    assert records == [
+        {"Name": name, "Timestamp": ts, "Confidence": conf} for name, ts, conf in ROWS[5:]
+    ]
+
+
+def test_export_with_no_matching_rows(attendance_path):
+    assert "".join(iter_export(attendance_path, None, None, "csv")) == (
+        "Name,Timestamp,Confidence\n"
+    )
+    assert "".join(iter_export(attendance_path, None, None, "ndjson")) == ""
+
+
+def test_refresh_reindexes_after_rewrite(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+    assert rollup.refresh(attendance_path) is False
+
+    # Appends indexed through record_append keep the index current
+    log_row(rollup, attendance_path, ("Bob", "2025-07-18 09:00:00", "0.7500"))
+    assert rollup.refresh(attendance_path) is False
+    assert rollup.dates[-1] == "2025-07-18"
+
+    # Rotation replaces the file; offsets must be rebuilt, not reused
+    os.remove(attendance_path)
+    write_rows(attendance_path, ROWS[5:])
+    assert rollup.refresh(attendance_path) is True
+    assert rollup.dates == ["2025-07-17"]
+    assert rollup.total_records == 2
+
+    output = "".join(iter_export(attendance_path, rollup.start_offset(), None, "csv"))
+    assert [tuple(r) for r in csv.reader(output.splitlines()[1:])] == ROWS[5:]
+
+
+def test_truncate_then_log_reindexes(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    # copytruncate-style rotation keeps the inode but empties the file
+    with open(attendance_path, "r+") as f:
+        f.truncate(0)
+    log_row(rollup, attendance_path, ("Bob", "2025-07-20 09:00:00", "0.7500"))
+
+    assert rollup.dates == ["2025-07-20"]
+    assert rollup.start_offset("2025-07-15") == rollup.day_offsets["2025-07-20"]
+    output = "".join(iter_export(attendance_path, rollup.start_offset(), None, "csv"))
+    assert [tuple(r) for r in csv.reader(output.splitlines()[1:])] == [
+        ("Bob", "2025-07-20 09:00:00", "0.7500")
+    ]
+
+
+def test_first_log_without_load_indexes_history(attendance_path):
+    rollup = AttendanceRollup()
+    log_row(rollup, attendance_path, ("Bob", "2025-07-18 09:00:00", "0.7500"))
+
+    assert rollup.total_records == len(ROWS) + 1
+    assert rollup.dates[0] == "2025-07-15"
+
+
+def test_append_by_another_writer_is_not_lost(attendance_path):
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+
+    # Another replica appends between our refresh and our write
+    rollup.refresh(attendance_path)
+    write_rows(attendance_path, [("Eve", "2025-07-18 08:00:00", "0.7000")])
+    with open(attendance_path, "a", newline="") as f:
+        offset = f.tell()
+        csv.writer(f).writerow(("Bob", "2025-07-18 09:00:00", "0.7500"))
+        end = f.tell()
+    rollup.record_append(attendance_path, "Bob", "2025-07-18 09:00:00", offset, end)
+
+    day = rollup.daily_summary("2025-07-18")[0]
+    assert day == {"date": "2025-07-18", "headcount": 2, "records": 2}
+
+
+def test_non_utf8_rows_do_not_break_load_or_export(attendance_path):
+    with open(attendance_path, "ab") as f:
+        f.write(b"Ren\xe9e,2025-07-18 09:00:00,0.7000\r\n")
+        f.write(b"Bob,2025-07-18 10:00:00,0.7500\r\n")
+
+    rollup = AttendanceRollup()
+    rollup.load(attendance_path)
+    assert rollup.daily_summary("2025-07-18")[0]["records"] == 2
+
+    offset = rollup.start_offset("2025-07-18")
+    output = "".join(iter_export(attendance_path, offset, None, "ndjson"))
+    records = [json.loads(line) for line in output.splitlines()]
+    assert [r["Timestamp"] for r in records] == [
+        "2025-07-18 09:00:00",
+        "2025-07-18 10:00:00",
+    ]
+
+
+def test_load_without_header_keeps_first_row(tmp_path):
+    path = tmp_path / "attendance.csv"
+    path.write_text("Alice,2025-07-15 09:00:00,0.8000\r\n")
+
+    rollup = AttendanceRollup()
+    rollup.load(str(path))
+    assert rollup.total_records == 1
+    assert rollup.start_offset() == 0
@@ -0,0 +1,135 @@
+"""
+Tests for vectorized gallery matching and the open-set decision rule
+"""
+
+import os
+import sys
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+pytest.importorskip("PIL")
+
+# Matching never calls into dlib; a placeholder keeps the import working
+# where the native build is unavailable
+try:
+    import dlib  # noqa: F401
+except ImportError:
+    sys.modules["dlib"] = types.ModuleType("dlib")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "backend"))
+from direct_recognizer import DirectDlibRecognizer
+
+
+def make_recognizer(known_encodings, query=None):
+    """Build a recognizer without loading models, optionally stubbing encoding"""
+    recognizer = DirectDlibRecognizer.__new__(DirectDlibRecognizer)
+    recognizer.known_encodings = known_encodings
+    recognizer.build_gallery()
+    if query is not None:
+        recognizer.get_face_encoding = lambda image: query
+    return recognizer
+
+
+def brute_force(known_encodings, query):
+    """Per-person minimum distance computed the way the original loop did"""
+    distances = {
+        name: min(np.linalg.norm(encoding - query) for encoding in encodings)
+        for name, encodings in known_encodings.items()
+        if encodings
+    }
+    return sorted(distances.items(), key=lambda item: item[1])
+
+
+@pytest.fixture
+def gallery():
+    rng = np.random.default_rng(7)
+    return {
+        f"person_{i}": [rng.normal(size=128) * 0.1 for _ in range(rng.integers(1, 5))]
+        for i in range(12)
+    }
+
+
+def test_match_candidates_matches_brute_force(gallery):
+    rng = np.random.default_rng(11)
+    recognizer = make_recognizer(gallery)
+
+    for _ in range(20):
+        query = rng.normal(size=128) * 0.1
+        expected = brute_force(gallery, query)
+        for top_k in (1, 3, len(gallery), len(gallery) + 5):
+            result = recognizer.match_candidates(query, top_k=top_k)
+            assert [name for name, _ in result] == [name for name, _ in expected[:top_k]]
+            assert np.allclose(
+                [d for _, d in result], [d for _, d in expected[:top_k]]
+            )
+
+
+def test_person_without_encodings_is_skipped():
+    base = np.zeros(128)
+    recognizer = make_recognizer({"empty": [], "alice": [base], "bob": [base + 0.1]})
+
+    names = [name for name, _ in recognizer.match_candidates(base, top_k=5)]
+    assert names == ["alice", "bob"]
+
+
+def test_empty_gallery_returns_no_candidates():
+    recognizer = make_recognizer({})
+    assert recognizer.match_candidates(np.zeros(128), top_k=3) == []
+
+
+def test_accepted_match_reports_margin_and_candidates():
+    base = np.zeros(128)
+    alice = base.copy()
+    bob = base.copy()
+    bob[0] = 0.5
+    recognizer = make_recognizer({"alice": [alice], "bob": [bob]}, query=base)
+
+    result = recognizer.recognize_face(None, tolerance=0.6, top_k=2, min_margin=0.1)
+
+    assert result["name"] == "alice"
+    assert result["distance"] == pytest.approx(0.0)
+    assert result["margin"] == pytest.approx(0.5)
+    assert result["margin_confidence"] == pytest.approx(0.5 / 0.6)
+    assert [c["name"] for c in result["candidates"]] == ["alice", "bob"]
+    assert result["registration_required"] is False
+
+
+def test_close_runner_up_is_ambiguous():
+    base = np.zeros(128)
+    alice = base.copy()
+    alice[0] = 0.1
+    bob = base.copy()
+    bob[0] = -0.15
+    recognizer = make_recognizer({"alice": [alice], "bob": [bob]}, query=base)
+
+    result = recognizer.recognize_face(None, tolerance=0.6, top_k=1, min_margin=0.1)
+
+    assert result["name"] is None
+    assert result["ambiguous"] is True
+    assert result["margin"] == pytest.approx(0.05)
+    assert [c["name"] for c in result["candidates"]] == ["alice"]
+    assert result["registration_required"] is False
+
+
+def test_distant_face_is_unknown():
+    far = np.full(128, 1.0)
+    recognizer = make_recognizer({"alice": [np.zeros(128)]}, query=far)
+
+    result = recognizer.recognize_face(None, tolerance=0.6)
+
+    assert result["name"] is None
+    assert result["registration_required"] is True
+    assert "ambiguous" not in result
+
+
+def test_single_identity_has_no_margin():
+    recognizer = make_recognizer({"alice": [np.zeros(128)]}, query=np.zeros(128))
+
+    result = recognizer.recognize_face(None, tolerance=0.6, min_margin=0.5)
+
+    assert result["name"] == "alice"
+    assert result["margin"] is None
+    assert result["margin_confidence"] is None